@@ -1,10 +1,17 @@
 import streamlit as st
-import json
-import pandas as pd
+import orjson
 import psycopg2 
+import psycopg2.pool
+from psycopg2.extras import RealDictCursor
 from decimal import Decimal
 import google.generativeai as genai
 import re
+import hashlib
+import threading
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
 from supabase import create_client, Client
 
 # Carregar credenciais de forma segura
@@ -16,6 +23,8 @@ except KeyError:
     st.stop()
 
 supabase_url = st.secrets["SUPABASE_URL"]
+# Deve ser a chave service_role: a view omni_dic_schema_text (sql/omni_dic_schema_text.sql)
+# só concede SELECT a esse papel, já que views materializadas não têm RLS
 supabase_key = st.secrets["SUPABASE_KEY"]
 
 # Credenciais do PostgreSQL
@@ -25,6 +34,45 @@ pg_database = st.secrets["PG_DATABASE"]
 pg_user = st.secrets["PG_USER"]
 pg_password = st.secrets["PG_PASSWORD"]
 
+# Remove as cercas ```sql ... ``` que o LLM às vezes devolve ao redor da consulta
+_SQL_FENCE = re.compile(r'^\s*```(?:sql)?\s*|\s*```\s*$', re.MULTILINE | re.IGNORECASE)
+# Comentários iniciais (-- e /* */) que o LLM às vezes coloca antes da consulta
+_SQL_LEADING_COMMENTS = re.compile(r'^(?:\s*(?:--[^\n]*|/\*.*?\*/))*\s*', re.DOTALL)
+# Aceita também consultas entre parênteses, como "(SELECT ...) UNION (SELECT ...)"
+_SQL_READ_ONLY = re.compile(r'^[\s(]*(with|select)\b', re.IGNORECASE)
+# ';' final, inclusive quando seguido de comentários de linha (ex.: "SELECT 1;  -- ok")
+_SQL_TRAILING_SEMICOLON = re.compile(r';\s*(?:--[^\n]*\s*)*$')
+
+_WHITESPACE = re.compile(r'\s+')
+_WORD = re.compile(r'[a-z0-9]+')
+_TRAILING_PUNCTUATION = re.compile(r'[\s?!.]+$')
+
+# Quantidade de tabelas do esquema enviadas ao LLM na geração do SQL
+SCHEMA_TOP_K = 5
+# Peso de um termo da pergunta que aparece no nome da tabela ou de uma coluna
+SCHEMA_NAME_WEIGHT = 3
+
+# Palavras comuns nas perguntas que não indicam tabela alguma (sem acento; ignoradas só na pergunta)
+_STOPWORDS = frozenset((
+    "quantos quantas quanto quanta quais qual para mais menos cada como onde quando "
+    "pelo pela pelos pelas entre sobre todos todas esse essa este esta isso existem temos "
+    "possui possuem lista listar mostre mostrar qualquer foram sido estao"
+).split())
+
+# Máximo de linhas retornadas por qualquer consulta gerada
+SQL_ROW_LIMIT = 1000
+
+# Conexões do pool: cada pergunta em andamento segura uma durante toda a geração do SQL
+POOL_MAX_CONNECTIONS = 20
+# Segundos que uma consulta espera por conexão livre quando o pool está esgotado
+POOL_WAIT_TIMEOUT = 10
+
+# Tempo máximo de execução de cada consulta gerada pelo LLM
+SQL_STATEMENT_TIMEOUT = '10s'
+
+# Máximo de linhas do resultado repassadas ao LLM na resposta final
+MAX_ROWS_TO_LLM = 200
+
 # Inicializar os clientes
 model = genai.GenerativeModel('gemini-1.5-flash-latest') 
 supabase_client: Client = create_client(supabase_url, supabase_key)
@@ -39,65 +87,114 @@ for message in st.session_state.messages:
     with st.chat_message(message["role"]):
         st.markdown(message["content"])
 
-@st.cache_data
+@st.cache_resource(ttl=3600)
 def get_database_schema():
-    """Recupera e formata o dicionário de dados do Supabase."""
-    
-    tabelas_data = supabase_client.from_("omni_dic_tabela").select("nm_tabela, ds_tabela").execute().data
-    tabelas_df = pd.DataFrame(tabelas_data)
-    
-    atributos_data = supabase_client.from_("omni_dic_atributo").select("nm_tabela, nm_atributo, ds_tipo_dado, cd_dominio, ds_atributo").execute().data
-    atributos_df = pd.DataFrame(atributos_data)
-    
-    constraints_data = supabase_client.from_("omni_dic_constraint").select("ds_tipo_constraint, nm_tabela, nm_atributo, nm_tabela_referenciada, nm_atributo_referenciado").execute().data
-    constraints_df = pd.DataFrame(constraints_data)
+    """Lê o dicionário de dados pré-agregado do Supabase e o organiza em seções por tabela."""
     
-    dominios_data = supabase_client.from_("omni_dic_dominio").select("cd_dominio, ds_dominio").execute().data
-    dominios_df = pd.DataFrame(dominios_data)
+    # A view materializada omni_dic_schema_text (sql/omni_dic_schema_text.sql) já cruza as
+    # tabelas omni_dic_*: uma única consulta substitui as seis buscas separadas
+    linhas = supabase_client.from_("omni_dic_schema_text").select("ds_schema").execute().data
+    if not linhas:
+        raise RuntimeError(
+            "Dicionário de dados indisponível: a view omni_dic_schema_text está vazia ou não pode ser "
+            "lida. Verifique se sql/omni_dic_schema_text.sql foi aplicado e se SUPABASE_KEY é a chave service_role."
+        )
+    dados = linhas[0]["ds_schema"]
 
-    # NOVO: Recuperar dados das novas tabelas
-    conceito_data = supabase_client.from_("omni_dic_conceito").select("nm_conceito, ds_conceito").execute().data
-    sql_exemplo_data = supabase_client.from_("omni_dic_sql_exemplo").select("ds_metrica, ds_sql").execute().data
+    # Uma seção por tabela, para que cada pergunta receba apenas as tabelas relevantes
+    tabelas = {}
+    for item in dados["tabelas"]:
+        tabela = item['nm_tabela']
+        atributos = [f"#### {tabela}\n"]
+        for row in item['atributos']:
+            atributos.append(f"- **{row['nm_atributo']}** ({row['ds_tipo_dado']}): {row['ds_atributo']}\n")
+            if row['valores']:
+                valores = ', '.join([f"'{d}'" for d in row['valores']])
+                atributos.append(f"  (Valores possíveis: {valores})\n")
+
+        relacionamentos = [
+            f"- `{tabela}.{row['nm_atributo']}` referencia "
+            f"`{row['nm_tabela_referenciada']}.{row['nm_atributo_referenciado']}`\n"
+            for row in item['relacionamentos']
+        ]
+
+        secao = {
+            "descricao": f"- **{tabela}**: {item['ds_tabela']}\n" if item['ds_tabela'] is not None else "",
+            "atributos": "".join(atributos),
+            "relacionamentos": "".join(relacionamentos),
+        }
+        secao["termos"] = _stems(" ".join([tabela, *secao.values()]))
+        # Nomes de tabela e colunas pesam mais que palavras das descrições na seleção
+        secao["nomes"] = _stems(" ".join([tabela, *(row['nm_atributo'] for row in item['atributos'])]))
+        secao["referencias"] = [row['nm_tabela_referenciada'] for row in item['relacionamentos']]
+        tabelas[tabela] = secao
 
-    schema_info = "## Estrutura do Banco de Dados\n\n"
-    schema_info += "### Tabelas e Descrições\n"
-    for _, row in tabelas_df.iterrows():
-        schema_info += f"- **{row['nm_tabela']}**: {row['ds_tabela']}\n"
-    
-    schema_info += "\n### Atributos das Tabelas\n"
-    for tabela in atributos_df['nm_tabela'].unique():
-        schema_info += f"#### {tabela}\n"
-        tabela_atributos = atributos_df[atributos_df['nm_tabela'] == tabela]
-        for _, row in tabela_atributos.iterrows():
-            schema_info += f"- **{row['nm_atributo']}** ({row['ds_tipo_dado']}): {row['ds_atributo']}\n"
-            if pd.notna(row['cd_dominio']) and row['cd_dominio']:
-                dominios = dominios_df[dominios_df['cd_dominio'] == row['cd_dominio']]
-                if not dominios.empty:
-                    valores = ', '.join([f"'{d}'" for d in dominios['ds_dominio'].tolist()])
-                    schema_info += f"  (Valores possíveis: {valores})\n"
-
-    schema_info += "\n### Relacionamentos entre Tabelas\n"
-    for _, row in constraints_df.iterrows():
-        if row['ds_tipo_constraint'] == 'Foreign Key':
-            schema_info += (f"- `{row['nm_tabela']}.{row['nm_atributo']}` referencia "
-                            f"`{row['nm_tabela_referenciada']}.{row['nm_atributo_referenciado']}`\n")
-                            
     # NOVO: Adicionar conceitos de negócio
-    schema_info += "\n## Conceitos de Negócio\n"
-    for item in conceito_data:
-        schema_info += f"- **{item['nm_conceito']}**: {item['ds_conceito']}\n"
+    parts = ["\n## Conceitos de Negócio\n"]
+    for item in dados["conceitos"]:
+        parts.append(f"- **{item['nm_conceito']}**: {item['ds_conceito']}\n")
         
     # NOVO: Adicionar exemplos de consultas
-    schema_info += "\n## Exemplos de Consultas\n"
-    for item in sql_exemplo_data:
-        schema_info += f"- Pergunta: {item['ds_metrica']}\n  SQL: {item['ds_sql']}\n"
+    parts.append("\n## Exemplos de Consultas\n")
+    for item in dados["exemplos"]:
+        parts.append(f"- Pergunta: {item['ds_metrica']}\n  SQL: {item['ds_sql']}\n")
+
+    # Versão do esquema: compõe a chave do cache de respostas, invalidando-o quando o dicionário muda
+    versao = hashlib.blake2b(orjson.dumps(dados), digest_size=8).hexdigest()
+
+    return {"tabelas": tabelas, "geral": "".join(parts), "versao": versao}
+
+def _stems(text, stopwords=frozenset()):
+    """Radicais (5 primeiras letras, sem acento) das palavras do texto, para comparar pergunta e esquema."""
+    text = unicodedata.normalize('NFKD', text.lower()).encode('ascii', 'ignore').decode()
+    # As stopwords são comparadas pela palavra inteira: "quantos" não elimina "quantidade"
+    return frozenset(
+        word[:5] for word in _WORD.findall(text) if len(word) >= 4 and word not in stopwords
+    )
+
+def format_schema(schema, nomes):
+    """Monta o texto do esquema em Markdown apenas com as tabelas indicadas."""
+    tabelas = [schema["tabelas"][nome] for nome in nomes]
+    parts = ["## Estrutura do Banco de Dados\n\n", "### Tabelas e Descrições\n"]
+    parts.extend(t["descricao"] for t in tabelas)
+    parts.append("\n### Atributos das Tabelas\n")
+    parts.extend(t["atributos"] for t in tabelas)
+    parts.append("\n### Relacionamentos entre Tabelas\n")
+    parts.extend(t["relacionamentos"] for t in tabelas)
+    parts.append(schema["geral"])
+    return "".join(parts)
+
+def select_schema(schema, prompt, k=SCHEMA_TOP_K):
+    """Seleciona as k tabelas mais próximas da pergunta (e as que elas referenciam) e formata o esquema reduzido."""
+    termos = _stems(prompt, _STOPWORDS)
+    scores = {
+        nome: SCHEMA_NAME_WEIGHT * len(termos & t["nomes"]) + len(termos & t["termos"])
+        for nome, t in schema["tabelas"].items()
+    }
+    relevantes = [nome for nome in sorted(scores, key=scores.get, reverse=True)[:k] if scores[nome]]
+    # Inclui as tabelas referenciadas pelas escolhidas: sem elas o LLM não tem o caminho dos JOINs
+    for nome in list(relevantes):
+        for ref in schema["tabelas"][nome]["referencias"]:
+            if ref in schema["tabelas"] and ref not in relevantes:
+                relevantes.append(ref)
+    # Sem nenhuma tabela relacionada à pergunta, envia o esquema completo
+    return format_schema(schema, relevantes or list(schema["tabelas"]))
 
-    return schema_info
+if st.sidebar.button("Atualizar esquema"):
+    get_database_schema.clear()
 
-database_schema = get_database_schema()
+def _schema():
+    """Esquema carregado sob demanda, só quando uma pergunta precisa dele (cacheado entre reruns)."""
+    return get_database_schema()
+
+def normalize_prompt(prompt):
+    """Normaliza a pergunta para uso como chave de cache: minúsculas, espaços únicos e sem ?!. finais."""
+    # Operadores, vírgulas e sinais são mantidos: "> 1000" e "< 1000" são perguntas diferentes
+    return _TRAILING_PUNCTUATION.sub('', _WHITESPACE.sub(' ', prompt.lower()).strip())
 
 def get_sql_query_from_llm(prompt):
     """Gera a consulta SQL baseada na pergunta do usuário."""
+    schema = select_schema(_schema(), prompt)
     sql_prompt = (
         f"Você é um especialista em SQL. Sua tarefa é converter a pergunta do usuário em uma "
         f"consulta SQL válida, **usando estritamente APENAS** as tabelas e colunas fornecidas no esquema. "
@@ -110,71 +207,203 @@ def get_sql_query_from_llm(prompt):
         f"5. Use JOINs apenas para tabelas que estejam explicitamente relacionadas no esquema.\n"
         f"6. Para contagem, utilize `COUNT(*)` ou `COUNT(1)`.\n"
         f"7. Para calcular a média de uma contagem ou soma (agregação aninhada), use uma subquery. Por exemplo, `SELECT AVG(total_contas) FROM (SELECT COUNT(*) AS total_contas FROM CONTA GROUP BY ID_PRESTADOR_ENVIO) AS subquery;`.\n\n"
-        f"Esquema do Banco de Dados:\n{database_schema}\n\n"
+        f"Esquema do Banco de Dados:\n{schema}\n\n"
         f"Pergunta do usuário: {prompt}"
     )
     
-    response = model.generate_content(sql_prompt, generation_config=genai.types.GenerationConfig(
+    stream = model.generate_content(sql_prompt, generation_config=genai.types.GenerationConfig(
         temperature=0.1,
-    ))
-    return response.text.strip()
+    ), stream=True)
+
+    # Interrompe a leitura assim que a consulta estiver completa, ignorando o restante da geração
+    buf = []
+    for chunk in stream:
+        buf.append(chunk.text)
+        text = "".join(buf)
+        if text.rstrip().endswith(';') or text.count("```") >= 2:
+            break
+    return "".join(buf).strip()
+
+def sanitize_sql(query):
+    """Limpa o SQL gerado pelo LLM e garante que seja uma consulta somente leitura com LIMIT."""
+    query = _SQL_TRAILING_SEMICOLON.sub('', _SQL_FENCE.sub('', query).strip())
+    query = _SQL_LEADING_COMMENTS.sub('', query)
+    if not _SQL_READ_ONLY.match(query):
+        raise ValueError("Apenas consultas de leitura (SELECT) são permitidas.")
+    # Envolve a consulta em vez de anexar LIMIT ao texto: funciona com LIMIT em subqueries,
+    # FETCH FIRST e comentários finais (as quebras de linha impedem que um "--" engula o fechamento)
+    # Uma linha a mais que o limite permite a execute_sql_query detectar que o resultado foi cortado
+    return f"SELECT * FROM (\n{query}\n) AS q LIMIT {SQL_ROW_LIMIT + 1}"
+
+@st.cache_resource(show_spinner=False)
+def get_connection_pool():
+    """Cria o pool de conexões com o PostgreSQL, compartilhado entre sessões e reruns."""
+    return psycopg2.pool.ThreadedConnectionPool(
+        1, POOL_MAX_CONNECTIONS,
+        host=pg_host,
+        port=pg_port,
+        database=pg_database,
+        user=pg_user,
+        password=pg_password,
+        keepalives=1,
+        keepalives_idle=30,
+    )
+
+@st.cache_resource
+def get_executor():
+    """Executor compartilhado para tarefas em segundo plano (ex.: pré-abertura de conexões)."""
+    return ThreadPoolExecutor(max_workers=4)
 
-def execute_sql_query(query):
-    """Executa a consulta SQL usando psycopg2 e retorna os dados."""
+def _prefetch_getconn():
+    """Tarefa de segundo plano: cria o pool (se preciso) e obtém uma conexão, ou None se esgotado."""
+    try:
+        return get_connection_pool().getconn()
+    except psycopg2.pool.PoolError:
+        # Pool esgotado: execute_sql_query aguarda uma conexão livre na hora de executar
+        return None
+
+def prefetch_connection():
+    """Obtém uma conexão do pool em segundo plano, em paralelo à geração do SQL."""
+    return get_executor().submit(_prefetch_getconn)
+
+def release_prefetched_connection(conn_future):
+    """Devolve ao pool uma conexão pré-obtida que não chegou a ser usada."""
+    def _release(future):
+        if future.exception() is None and future.result() is not None:
+            get_connection_pool().putconn(future.result())
+    conn_future.add_done_callback(_release)
+
+def _getconn_waiting(pool):
+    """getconn que, com o pool esgotado, espera até POOL_WAIT_TIMEOUT segundos por uma conexão livre."""
+    deadline = time.monotonic() + POOL_WAIT_TIMEOUT
+    while True:
+        try:
+            return pool.getconn()
+        except psycopg2.pool.PoolError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.05)
+
+def execute_sql_query(query, conn_future=None):
+    """Executa a consulta SQL (conexão do pool ou pré-obtida em conn_future) e retorna (linhas, cortado)."""
     conn = None
-    data = None
     try:
-        query = re.sub(r'^\s*```sql|```\s*$', '', query, flags=re.MULTILINE).strip()
-        
-        conn = psycopg2.connect(
-            host=pg_host,
-            port=pg_port, 
-            database=pg_database,
-            user=pg_user,
-            password=pg_password
-        )
-        cur = conn.cursor()
-        cur.execute(query)
-        
-        if cur.description:
-            data = cur.fetchall()
-            column_names = [desc[0] for desc in cur.description]
-            
-            results_as_dict = [dict(zip(column_names, row)) for row in data]
-            
-            for row_dict in results_as_dict:
-                for key, value in row_dict.items():
-                    if isinstance(value, Decimal):
-                        row_dict[key] = float(value)
-        else:
-            results_as_dict = {"message": f"{cur.rowcount} linhas afetadas."}
-
-        cur.close()
-        conn.close()
-        return results_as_dict
+        pool = get_connection_pool()
+        conn = conn_future.result() if conn_future else None
+        if conn is None:
+            conn = _getconn_waiting(pool)
+        # Transação somente leitura e com tempo limite: o SQL gerado pelo LLM não pode
+        # alterar dados nem prender o banco. Ambos valem só até o putconn (rollback).
+        with conn.cursor() as cur:
+            cur.execute("SET TRANSACTION READ ONLY")
+            cur.execute("SET LOCAL statement_timeout = %s", (SQL_STATEMENT_TIMEOUT,))
+
+        # Cursor nomeado (server-side): as linhas chegam em lotes de itersize em vez de todas
+        # de uma vez, já como dicionários montados pelo RealDictCursor
+        with conn.cursor(name="stream_cur", cursor_factory=RealDictCursor) as cur:
+            cur.itersize = 2000
+            cur.execute(query)
+            # Decimal é convertido só na serialização para o LLM (_json_default)
+            results_as_dict = list(cur)
+
+        truncated = len(results_as_dict) > SQL_ROW_LIMIT
+        return results_as_dict[:SQL_ROW_LIMIT], truncated
     except Exception as e:
         st.error(f"Erro ao executar a consulta SQL: {e}")
-        if conn:
-            conn.close()
         return None
+    finally:
+        if conn:
+            # putconn desfaz transações pendentes e descarta conexões fechadas
+            pool.putconn(conn)
+        elif conn_future:
+            # Interrompida antes de obter a conexão pré-aberta: devolve-a quando ficar pronta
+            release_prefetched_connection(conn_future)
 
-def get_final_response_from_llm(prompt, data):
+def _json_default(value):
+    """Serializa para o orjson os tipos que ele não trata nativamente (ex.: Decimal do NUMERIC)."""
+    if isinstance(value, Decimal):
+        return float(value)
+    return str(value)
+
+def get_final_response_from_llm(prompt, data, truncated=False):
     """Gera a resposta final usando a pergunta original e os dados recuperados."""
+    total_rows = len(data)
+    avisos = []
+    if truncated:
+        # O resultado atingiu SQL_ROW_LIMIT: o total real é desconhecido
+        total_desc = f"mais de {SQL_ROW_LIMIT}"
+        avisos.append(
+            f"Atenção: a consulta retornou mais de {SQL_ROW_LIMIT} linhas e o total exato não é "
+            f"conhecido. Não apresente contagens de linhas como exatas.\n"
+        )
+    else:
+        total_desc = str(total_rows)
+    # Limita as linhas enviadas ao modelo para conter o tamanho do prompt, avisando-o do corte
+    if total_rows > MAX_ROWS_TO_LLM:
+        data = data[:MAX_ROWS_TO_LLM]
+        avisos.append(
+            f"Apenas as primeiras {MAX_ROWS_TO_LLM} linhas estão listadas abaixo; use o total "
+            f"informado para contagens e deixe claro ao usuário que a listagem está incompleta.\n"
+        )
     final_prompt = (
         f"Baseado na seguinte pergunta do usuário e nos dados obtidos do banco de dados, "
         f"gere uma resposta completa, clara e amigável. Os dados estão em formato JSON.\n\n"
         f"na resposta, não coloque informações ténicas do banco de dados ou das tabelas, "
         f"responda como se estivesse falando com o usuário final.\n\n"
         f"Pergunta do usuário: {prompt}\n"
-        f"Esquema do Banco de Dados:\n{database_schema}\n\n"
-        f"Dados do banco de dados: {json.dumps(data, indent=2)}\n"
+        f"Total de linhas retornadas pela consulta: {total_desc}\n"
+        f"{''.join(avisos)}"
+        f"Dados do banco de dados: {orjson.dumps(data, default=_json_default, option=orjson.OPT_NON_STR_KEYS).decode()}\n"
         f"Resposta completa e detalhada:"
     )
 
-    response = model.generate_content(final_prompt, generation_config=genai.types.GenerationConfig(
+    # stream=True: o primeiro trecho chega antes da resposta completa ser gerada
+    return model.generate_content(final_prompt, generation_config=genai.types.GenerationConfig(
         temperature=0.5,
-    ))
-    return response.text.strip()
+    ), stream=True)
+
+@st.cache_resource
+def get_answer_cache():
+    """Cache de respostas finais compartilhado entre sessões, limitado em tamanho e validade."""
+    return TTLCache(maxsize=512, ttl=600), threading.Lock()
+
+def get_cached_answer(key):
+    """Retorna a resposta já gerada para (pergunta normalizada, versão do esquema), se houver."""
+    cache, lock = get_answer_cache()
+    with lock:
+        return cache.get(key)
+
+def store_answer(key, answer):
+    """Guarda a resposta final gerada para reutilização em perguntas repetidas."""
+    cache, lock = get_answer_cache()
+    with lock:
+        cache[key] = answer
+
+@st.cache_resource
+def get_sql_cache():
+    """Cache de SQL já validado e executado com sucesso, compartilhado entre sessões."""
+    return TTLCache(maxsize=256, ttl=3600), threading.Lock()
+
+def get_cached_sql(key):
+    """Retorna o SQL que já funcionou para (pergunta normalizada, versão do esquema), se houver."""
+    cache, lock = get_sql_cache()
+    with lock:
+        return cache.get(key)
+
+def store_sql(key, sql_query):
+    """Guarda o SQL sanitizado depois de executado sem erro."""
+    cache, lock = get_sql_cache()
+    with lock:
+        cache[key] = sql_query
+
+@st.cache_resource(show_spinner=False)
+def _warm_schema():
+    """Dispara, uma única vez por processo, o carregamento do esquema em segundo plano."""
+    # Thread própria: não ocupa o executor usado na pré-abertura de conexões
+    threading.Thread(target=_schema, daemon=True).start()
+
+# Aquece o cache do esquema sem bloquear a renderização da página
+_warm_schema()
 
 # Lógica do chat
 if prompt := st.chat_input("Faça sua pergunta..."):
@@ -183,23 +412,53 @@ if prompt := st.chat_input("Faça sua pergunta..."):
         st.markdown(prompt)
 
     with st.chat_message("assistant"):
-        with st.spinner("Gerando consulta SQL..."):
-            try:
-                sql_query = get_sql_query_from_llm(prompt)
-                sql_query = re.sub(r'^\s*```sql|```\s*$', '', sql_query, flags=re.MULTILINE).strip()
-                # st.write(f"SQL gerado: `{sql_query}`")
-
-                with st.spinner("Executando consulta no banco de dados..."):
-                    db_result = execute_sql_query(sql_query)
+        try:
+            # Perguntas repetidas (mesmo esquema) são respondidas direto do cache, sem LLM nem banco
+            answer_key = (normalize_prompt(prompt), _schema()["versao"])
+            cached_response = get_cached_answer(answer_key)
+            if cached_response is not None:
+                st.markdown(cached_response)
+                st.session_state.messages.append({"role": "assistant", "content": cached_response})
+            else:
+                # A conexão é aberta enquanto o LLM gera o SQL, fora do caminho crítico
+                conn_future = prefetch_connection()
+                try:
+                    # Reaproveita o SQL que já funcionou para esta pergunta; senão, pede ao LLM
+                    sql_query = get_cached_sql(answer_key)
+                    if sql_query is None:
+                        with st.spinner("Gerando consulta SQL..."):
+                            sql_query = sanitize_sql(get_sql_query_from_llm(prompt))
+                    # st.write(f"SQL gerado: `{sql_query}`")
+
+                    with st.spinner("Executando consulta no banco de dados..."):
+                        # Daqui em diante execute_sql_query é quem devolve a conexão ao pool
+                        owned_future, conn_future = conn_future, None
+                        db_result = execute_sql_query(sql_query, owned_future)
+                finally:
+                    # Cobre também RerunException/StopException do Streamlit, que herdam de
+                    # BaseException: sem isso a conexão ficaria presa e esgotaria o pool
+                    if conn_future is not None:
+                        release_prefetched_connection(conn_future)
                 
                 if db_result is None:
                     st.warning("Não foi possível executar a consulta. O fluxo será interrompido.")
                 else:
+                    # Só entra no cache o SQL que passou pelo sanitize_sql e executou sem erro
+                    store_sql(answer_key, sql_query)
+                    rows, truncated = db_result
                     with st.spinner("Gerando resposta final..."):
-                        final_response = get_final_response_from_llm(prompt, db_result)
-                        st.markdown(final_response)
-                        st.session_state.messages.append({"role": "assistant", "content": final_response})
+                        stream = get_final_response_from_llm(prompt, rows, truncated)
+
+                    # Fora dos spinners: o primeiro trecho da resposta substitui o indicador de carregamento
+                    placeholder = st.empty()
+                    buf = []
+                    for chunk in stream:
+                        buf.append(chunk.text)
+                        placeholder.markdown("".join(buf))
+                    final_response = "".join(buf).strip()
+                    st.session_state.messages.append({"role": "assistant", "content": final_response})
+                    store_answer(answer_key, final_response)
 
-            except Exception as e:
-                st.error(f"Ocorreu um erro no processo: {e}")
-                st.session_state.messages.append({"role": "assistant", "content": f"Ocorreu um erro: {e}"})
\ No newline at end of file
+        except Exception as e:
+            st.error(f"Ocorreu um erro no processo: {e}")
+            st.session_state.messages.append({"role": "assistant", "content": f"Ocorreu um erro: {e}"})
\ No newline at end of file
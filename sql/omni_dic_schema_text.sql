@@ -0,0 +1,112 @@
+-- Dicionário de dados pré-agregado a partir das tabelas omni_dic_*.
+-- O app lê esta view em uma única consulta (get_database_schema em app.py),
+-- em vez de buscar e cruzar as seis tabelas a cada inicialização.
+-- Todo jsonb_agg tem ORDER BY: o documento é hasheado pelo app (versão do esquema, chave dos
+-- caches), então um REFRESH sem mudança real precisa gerar exatamente o mesmo conteúdo.
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS omni_dic_schema_text AS
+WITH nomes AS (
+    SELECT nm_tabela FROM omni_dic_tabela
+    UNION
+    SELECT nm_tabela FROM omni_dic_atributo
+),
+dominios AS (
+    SELECT cd_dominio, jsonb_agg(ds_dominio ORDER BY ds_dominio) AS valores
+    FROM omni_dic_dominio
+    GROUP BY cd_dominio
+),
+atributos AS (
+    SELECT a.nm_tabela,
+           jsonb_agg(jsonb_build_object(
+               'nm_atributo', a.nm_atributo,
+               'ds_tipo_dado', a.ds_tipo_dado,
+               'ds_atributo', a.ds_atributo,
+               'valores', COALESCE(d.valores, '[]'::jsonb)
+           ) ORDER BY a.nm_atributo) AS atributos
+    FROM omni_dic_atributo a
+    LEFT JOIN dominios d ON d.cd_dominio = a.cd_dominio
+    GROUP BY a.nm_tabela
+),
+relacionamentos AS (
+    SELECT nm_tabela,
+           jsonb_agg(jsonb_build_object(
+               'nm_atributo', nm_atributo,
+               'nm_tabela_referenciada', nm_tabela_referenciada,
+               'nm_atributo_referenciado', nm_atributo_referenciado
+           ) ORDER BY nm_atributo, nm_tabela_referenciada, nm_atributo_referenciado) AS relacionamentos
+    FROM omni_dic_constraint
+    WHERE ds_tipo_constraint = 'Foreign Key'
+    GROUP BY nm_tabela
+)
+SELECT
+    1 AS id,
+    jsonb_build_object(
+        'tabelas', (
+            SELECT COALESCE(jsonb_agg(jsonb_build_object(
+                       'nm_tabela', n.nm_tabela,
+                       'ds_tabela', t.ds_tabela,
+                       'atributos', COALESCE(a.atributos, '[]'::jsonb),
+                       'relacionamentos', COALESCE(r.relacionamentos, '[]'::jsonb)
+                   ) ORDER BY n.nm_tabela), '[]'::jsonb)
+            FROM nomes n
+            LEFT JOIN omni_dic_tabela t ON t.nm_tabela = n.nm_tabela
+            LEFT JOIN atributos a ON a.nm_tabela = n.nm_tabela
+            LEFT JOIN relacionamentos r ON r.nm_tabela = n.nm_tabela
+        ),
+        'conceitos', (
+            SELECT COALESCE(jsonb_agg(jsonb_build_object(
+                       'nm_conceito', nm_conceito,
+                       'ds_conceito', ds_conceito
+                   ) ORDER BY nm_conceito), '[]'::jsonb)
+            FROM omni_dic_conceito
+        ),
+        'exemplos', (
+            SELECT COALESCE(jsonb_agg(jsonb_build_object(
+                       'ds_metrica', ds_metrica,
+                       'ds_sql', ds_sql
+                   ) ORDER BY ds_metrica, ds_sql), '[]'::jsonb)
+            FROM omni_dic_sql_exemplo
+        )
+    ) AS ds_schema;
+
+-- Índice único exigido pelo REFRESH ... CONCURRENTLY
+CREATE UNIQUE INDEX IF NOT EXISTS omni_dic_schema_text_id_idx ON omni_dic_schema_text (id);
+
+-- Views materializadas não têm RLS: o dicionário fica restrito ao papel usado pelo app
+-- (SUPABASE_KEY com a chave service_role). O REVOKE desfaz os privilégios padrão que o
+-- Supabase concede a anon/authenticated em objetos novos do schema public.
+REVOKE ALL ON omni_dic_schema_text FROM PUBLIC, anon, authenticated;
+GRANT SELECT ON omni_dic_schema_text TO service_role;
+
+-- Atualiza a view sempre que o dicionário de dados for alterado
+CREATE OR REPLACE FUNCTION refresh_omni_dic_schema_text()
+RETURNS trigger
+LANGUAGE plpgsql
+-- Executa como o dono da view (exigido pelo REFRESH), independente de quem alterou os dados
+SECURITY DEFINER
+SET search_path = public
+AS $$
+BEGIN
+    REFRESH MATERIALIZED VIEW CONCURRENTLY omni_dic_schema_text;
+    RETURN NULL;
+END;
+$$;
+
+DO $$
+DECLARE
+    tabela text;
+BEGIN
+    FOREACH tabela IN ARRAY ARRAY[
+        'omni_dic_tabela', 'omni_dic_atributo', 'omni_dic_constraint',
+        'omni_dic_dominio', 'omni_dic_conceito', 'omni_dic_sql_exemplo'
+    ] LOOP
+        EXECUTE format('DROP TRIGGER IF EXISTS refresh_omni_dic_schema_text ON %I', tabela);
+        EXECUTE format(
+            'CREATE TRIGGER refresh_omni_dic_schema_text '
+            'AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON %I '
+            'FOR EACH STATEMENT EXECUTE FUNCTION refresh_omni_dic_schema_text()',
+            tabela
+        );
+    END LOOP;
+END;
+$$;